@@ -0,0 +1,95 @@
+# Measures how long each chicraccoon command takes to start, and which heavy
+# dependencies it ends up importing.
+#
+# Every command is run in a fresh interpreter against a tiny synthetic backup,
+# so the numbers are dominated by interpreter startup and imports.
+#
+# usage: python benchmarks/import_time.py [repetitions]
+
+import os
+import os.path
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ['PIL', 'jinja2', 'pkg_resources', 'sqlite3',
+    'importlib.resources']
+
+def tar_header(name, size):
+    header = bytearray(512)
+    header[0:len(name)] = name
+    header[100:108] = b'0100666\x00'
+    header[124:136] = b'%011o\x00' % size
+    header[136:148] = b'%011d\x00' % 1
+    header[148:156] = b' ' * 8
+    header[148:156] = b'%06o\x00 ' % sum(header)
+    return bytes(header)
+
+def make_backup(path):
+    # a backup with a single uncompressed one-layer thumbnail
+    layer = b'\xff' * (150 * 175 // 2)
+    image = struct.pack('<HHL', 1, 0, len(layer)).ljust(512, b'\x00')
+    image += layer.ljust(((len(layer) + 4 + 511) // 512) * 512, b'\x00')
+
+    with open(path, 'wb') as f:
+        f.write(tar_header(b'THUMB.RAW', len(image)))
+        f.write(image)
+        f.write(b'\x00' * 512)
+        f.write(b'uxF\x00\x00'.ljust(512, b'\x00'))
+
+def run(args, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, env=env, check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def imported_modules(args, env):
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+        env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    names = set(line.rsplit('|', 1)[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith('import time:'))
+    return [x for x in HEAVY_MODULES if x in names]
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [x for x in [env.get('PYTHONPATH')] if x])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backup = os.path.join(tmp, 'enote.bkup')
+        make_backup(backup)
+
+        cli = ['-m', 'chicraccoon.cli']
+        sync = ['-m', 'chicraccoon.sync']
+        commands = [
+            ('python (baseline)', ['-c', 'pass']),
+            ('chicraccoon_cli', cli),
+            ('chicraccoon_cli list', cli + ['list', backup]),
+            ('chicraccoon_cli extract_file', cli + ['extract_file', backup,
+                'THUMB.RAW', os.path.join(tmp, 'thumb.raw')]),
+            ('chicraccoon_cli extract_image', cli + ['extract_image', backup,
+                'THUMB.RAW', os.path.join(tmp, 'thumb_%.png')]),
+            ('chicraccoon_cli verify', cli + ['verify', backup]),
+            ('chicraccoon_sync', sync),
+        ]
+
+        print('{:<32} {:>9} {:>9}  {}'.format(
+            'command', 'min (ms)', 'med (ms)', 'heavy imports'))
+        for name, args in commands:
+            # warm up (and compile .pyc files)
+            run(args, env)
+            times = [run(args, env) for _ in range(repetitions)]
+            print('{:<32} {:>9.1f} {:>9.1f}  {}'.format(name,
+                1000 * min(times), 1000 * statistics.median(times),
+                ', '.join(imported_modules(args, env)) or '-'))
+
+if __name__ == '__main__':
+    main()
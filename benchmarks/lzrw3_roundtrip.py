@@ -0,0 +1,62 @@
+# Round-trip benchmark for the LZRW3 implementation: compresses and
+# decompresses data shaped like image layers from a backup, and checks that
+# the result matches.
+#
+# usage: python benchmarks/lzrw3_roundtrip.py [repetitions]
+
+import os
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chicraccoon.lzrw3 import lzrw3_compress, lzrw3_decompress
+
+def page_layer(seed, strokes):
+    # a mostly white 600x700 layer with some horizontal strokes, roughly
+    # like a page of handwriting
+    rnd = random.Random(seed)
+    data = bytearray(b'\xff' * (600 * 700 // 2))
+    for _ in range(strokes):
+        start = rnd.randrange(len(data) - 64)
+        length = rnd.randrange(4, 64)
+        data[start:start + length] = bytes(
+            rnd.choice([0x00, 0x0f, 0xf0, 0x77]) for _ in range(length))
+    return bytes(data)
+
+def measure(fn, arg, repetitions):
+    times = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        result = fn(arg)
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+    inputs = [
+        ('blank page', b'\xff' * (600 * 700 // 2)),
+        ('light page', page_layer(1, 200)),
+        ('dense page', page_layer(2, 3000)),
+        ('random', random.Random(3).randbytes(600 * 700 // 2)),
+    ]
+
+    print('{:<12} {:>8} {:>8} {:>12} {:>12}'.format(
+        'input', 'size', 'ratio', 'comp (MB/s)', 'decomp (MB/s)'))
+    for name, data in inputs:
+        compressed, compress_time = measure(lzrw3_compress, data,
+            repetitions)
+        decompressed, decompress_time = measure(lzrw3_decompress, compressed,
+            repetitions)
+        assert decompressed == data
+
+        mb = len(data) / 1e6
+        print('{:<12} {:>8} {:>8.3f} {:>12.2f} {:>12.2f}'.format(name,
+            len(data), len(compressed) / len(data), mb / compress_time,
+            mb / decompress_time))
+
+if __name__ == '__main__':
+    main()
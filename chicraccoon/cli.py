@@ -1,6 +1,6 @@
 import sys
 
-from chicraccoon.enotebackup import EnoteBackup
+from chicraccoon.enotebackup import EnoteBackup, EnoteBackupError
 
 def cmd_list(backup_path):
     with EnoteBackup(backup_path) as backup:
@@ -37,6 +37,62 @@ def cmd_extract_image(backup_path, file_path, dest_path):
             print('saving layer {} to {}'.format(i, layer_path))
             layer.to_pil().save(layer_path)
 
+def cmd_verify(backup_path, full=False):
+    try:
+        with EnoteBackup(backup_path) as backup:
+            file_count = len(backup.files)
+            problems = backup.verify(full=full)
+    except EnoteBackupError as e:
+        file_count = 0
+        problems = [str(e)]
+
+    for problem in problems:
+        print(problem)
+
+    if problems:
+        print('FAILED: {} problem(s) found'.format(len(problems)))
+        sys.exit(1)
+
+    print('OK: {} files verified{}'.format(file_count,
+        ' (including full image decode)' if full else ''))
+
+def cmd_export_pdf(notebook_dir, backup_path, kind, id_, dest_path,
+        start_date=None, end_date=None):
+    import datetime
+    import os.path
+
+    from chicraccoon.pdfexport import export_pdf
+    from chicraccoon.sync import LocalNotebook
+
+    if not os.path.exists(os.path.join(notebook_dir, 'data.json')):
+        print('{} has not been synced yet (run chicraccoon_sync first)'
+            .format(notebook_dir))
+        return
+
+    notebook = LocalNotebook(notebook_dir)
+    id_ = int(id_)
+    parse_date = lambda x: datetime.datetime.strptime(x, '%Y-%m-%d').date()
+
+    if kind == 'notebook':
+        if id_ not in notebook.d['notebooks']:
+            print('notebook {} not found'.format(id_))
+            return
+        pages = notebook.notebook_page_images(id_)
+    elif kind == 'schedule':
+        if id_ not in notebook.d['schedules']:
+            print('schedule {} not found'.format(id_))
+            return
+        pages = notebook.schedule_page_images(id_,
+            parse_date(start_date) if start_date else None,
+            parse_date(end_date) if end_date else None)
+    else:
+        print('unknown kind {} (must be notebook or schedule)'.format(kind))
+        return
+
+    print('saving {} pages to {}'.format(len(pages), dest_path))
+    with EnoteBackup(backup_path) as backup:
+        export_pdf(backup, pages, dest_path)
+
 def main():
     if len(sys.argv) == 1:
         print('USAGE:')
@@ -45,6 +101,9 @@ def main():
         print('  - list <path/to/enote.bkup>')
         print('  - extract_file <path/to/enote.bkup> <path/to/file/in/backup> <path/to/destination.raw>')
         print('  - extract_image <path/to/enote.bkup> <path/to/file/in/backup> <path/to/destination_%.png>')
+        print('  - verify <path/to/enote.bkup> [--full]')
+        print('  - export_pdf <notebook-directory> <path/to/enote.bkup> notebook <id> <path/to/destination.pdf>')
+        print('  - export_pdf <notebook-directory> <path/to/enote.bkup> schedule <id> <path/to/destination.pdf> [<from YYYY-MM-DD> [<to YYYY-MM-DD>]]')
         return
 
     command = sys.argv[1]
@@ -54,6 +113,10 @@ def main():
         cmd_extract_file(sys.argv[2], sys.argv[3], sys.argv[4])
     elif command == 'extract_image':
         cmd_extract_image(sys.argv[2], sys.argv[3], sys.argv[4])
+    elif command == 'verify':
+        cmd_verify(sys.argv[2], '--full' in sys.argv[3:])
+    elif command == 'export_pdf':
+        cmd_export_pdf(*sys.argv[2:9])
     else:
         print('unknown command {}'.format(command))
 
@@ -1,8 +1,11 @@
 import io
+import os
+import sys
 
 from collections import namedtuple, OrderedDict
 
-from chicraccoon.enoteimage import EnoteImage
+from chicraccoon.enoteimage import EnoteImage, EnoteImageMode, \
+    padded_layer_size, parse_image_header
 
 def split_into_blocks(s, block_sizes):
     before = 0
@@ -13,11 +16,92 @@ def split_into_blocks(s, block_sizes):
 EnoteBackupFile = namedtuple('EnoteBackupFile',
     ['filename', 'is_dir', 'size', 'mtime', 'offset'])
 
+def _parse_int(s):
+    return int(s[:-1], 8)
+
+def _parse_str(s):
+    i = len(s)
+    while (i > 0) and (s[i - 1] == 0):
+        i -= 1
+    return s[:i]
+
+def padded_size(size):
+    size_padded = (size >> 9) << 9
+    if size & ((1 << 9) - 1) != 0:
+        size_padded += 1 << 9
+    return size_padded
+
+def parse_header(header, offset):
+    # offset is the position of the file data, right after the header
+    filename, mode, _, _, size, mtime, cksum, _, _ \
+        = split_into_blocks(header, [100, 8, 8, 8, 12, 12, 8, 1, 100])
+
+    filename = _parse_str(filename).replace(b'\\', b'/')
+    size = _parse_int(size)
+    if filename.startswith(b'+,;='):
+        mtime = 0
+    else:
+        mtime = int(mtime.strip(b'\x00'))
+    is_dir = mode[1] == ord('4')
+
+    return EnoteBackupFile(filename=filename, is_dir=is_dir, size=size,
+        mtime=mtime, offset=offset)
+
+class EnoteBackupError(Exception):
+    def __init__(self, message, problems=()):
+        super().__init__(message)
+        self.problems = list(problems)
+
+def header_checksum_ok(header):
+    # the checksum is the sum of all bytes of the header, with the checksum
+    # field itself taken to be all spaces. some implementations sum signed
+    # bytes, so both variants are accepted.
+    try:
+        cksum = int(header[148:156].strip(b'\x00 '), 8)
+    except ValueError:
+        return False
+
+    rest = header[:148] + header[156:]
+    unsigned = sum(rest) + 8 * ord(' ')
+    signed = unsigned - 256 * sum(1 for x in rest if x >= 128)
+    return cksum in (unsigned, signed)
+
+def update_header(header, size):
+    # returns a copy of a tar header with a different file size, and the
+    # checksum recomputed accordingly
+    header = bytearray(header)
+    header[124:135] = '{:011o}'.format(size).encode('ascii')
+    header[148:156] = b' ' * 8
+    header[148:156] = '{:06o}\x00 '.format(sum(header)).encode('ascii')
+    return bytes(header)
+
+def _check_image_task(args):
+    # runs in a worker process: fully decodes an image, returning a
+    # description of the problem or None
+    filename, data = args
+    try:
+        EnoteImage(data)
+    except Exception as e:
+        return '{}: failed to decode image ({})'.format(filename,
+            repr(e))
+    return None
+
 class EnoteBackup:
-    def __init__(self, filename, mode='rb'):
+    def __init__(self, filename, mode='rb', verify=False):
+        self.filename = filename
+        self.mode = mode
         self.fileobj = open(filename, mode)
         self.files = OrderedDict()
-        self._parse_files()
+        try:
+            self._parse_files()
+            if verify:
+                problems = self.verify()
+                if problems:
+                    raise EnoteBackupError('backup failed verification',
+                        problems)
+        except Exception:
+            self.fileobj.close()
+            raise
 
     def __enter__(self):
         return self
@@ -25,42 +109,95 @@ class EnoteBackup:
     def __exit__(self, exc_type, exc_value, traceback):
         self.fileobj.close()
 
-    def _parse_int(self, s):
-        return int(s[:-1], 8)
-
-    def _parse_str(self, s):
-        i = len(s)
-        while (i > 0) and (s[i - 1] == 0):
-            i -= 1
-        return s[:i]
-
     def _parse_files(self):
         while True:
             header = self.fileobj.read(512)
-            assert len(header) == 512
+            if len(header) != 512:
+                raise EnoteBackupError('unexpected end of backup')
 
             if header == b'\x00' * 512:
+                self.end_offset = self.fileobj.tell()
                 break
 
-            filename, mode, _, _, size, mtime, cksum, _, _ \
-                = split_into_blocks(header, [100, 8, 8, 8, 12, 12, 8, 1, 100])
+            f = parse_header(header, self.fileobj.tell())
+            self.files[f.filename] = f
+            self.fileobj.seek(padded_size(f.size), io.SEEK_CUR)
+
+    def _check_image_header(self, f):
+        name = f.filename.decode('utf-8', 'replace')
+        if f.size < 512:
+            return ['{}: image header truncated'.format(name)]
+
+        self.fileobj.seek(f.offset)
+        num_layers, flag, layer_sizes = \
+            parse_image_header(self.fileobj.read(512))
+
+        problems = []
+        if not (1 <= num_layers <= 3):
+            problems.append('{}: unexpected number of layers {}'.format(
+                name, num_layers))
+        if flag not in (0, 1):
+            problems.append('{}: unknown compression {}'.format(name, flag))
+        if problems:
+            return problems
+
+        extent = 512 + sum(padded_layer_size(x) for x in layer_sizes)
+        if extent > f.size:
+            problems.append('{}: layers need {} bytes, but file has {}'.format(
+                name, extent, f.size))
 
-            filename = self._parse_str(filename).replace(b'\\', b'/')
-            size = self._parse_int(size)
-            if filename.startswith(b'+,;='):
-                mtime = 0
+        if flag == 0:
+            known_sizes = [w * h // 2 for (w, h) in
+                (mode.dimensions() for mode in EnoteImageMode)]
+            for i, size in enumerate(layer_sizes):
+                if size not in known_sizes:
+                    problems.append('{}: layer {} has unexpected size {}'
+                        .format(name, i, size))
+
+        return problems
+
+    def verify(self, full=False, workers=None):
+        # checks tar header checksums, the backup trailer and the layer
+        # tables of all images, and returns a list of problems found.
+        # if full is set, all images are also decoded using a pool of
+        # `workers` processes.
+        problems = []
+
+        for f in self.files.values():
+            self.fileobj.seek(f.offset - 512)
+            if not header_checksum_ok(self.fileobj.read(512)):
+                problems.append('{}: bad header checksum'.format(
+                    f.filename.decode('utf-8', 'replace')))
+
+        self.fileobj.seek(self.end_offset)
+        trailer = self.fileobj.read(512)
+        if (len(trailer) != 512) or (not trailer.startswith(b'uxF')) or \
+            (trailer[5:] != b'\x00' * 507):
+            problems.append('backup trailer missing or malformed')
+
+        images = []
+        for f in self.files.values():
+            if f.is_dir or not f.filename.lower().endswith(b'.raw'):
+                continue
+            image_problems = self._check_image_header(f)
+            if image_problems:
+                problems.extend(image_problems)
             else:
-                mtime = int(mtime.strip(b'\x00'))
-            is_dir = mode[1] == ord('4')
+                images.append(f)
 
-            self.files[filename] = EnoteBackupFile(filename=filename,
-                is_dir=is_dir, size=size, mtime=mtime,
-                offset=self.fileobj.tell())
+        if full:
+            from concurrent.futures import ProcessPoolExecutor
+            from chicraccoon.workers import bounded_map
 
-            size_padded = (size >> 9) << 9
-            if size & ((1 << 9) - 1) != 0:
-                size_padded += 1 << 9
-            self.fileobj.seek(size_padded, io.SEEK_CUR)
+            workers = workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(workers) as executor:
+                tasks = ((f.filename.decode('utf-8', 'replace'),
+                          self.extract_file(f)) for f in images)
+                results = bounded_map(executor, _check_image_task, tasks,
+                    4 * workers)
+                problems.extend(x for x in results if x is not None)
+
+        return problems
 
     def list_files(self):
         return iter(self.files.values())
@@ -80,7 +217,171 @@ class EnoteBackup:
     def extract_image(self, f):
         return EnoteImage(self.extract_file(f))
 
+    def _copy_to(self, dest, size=None):
+        # copies size bytes (or everything up to the end of the backup)
+        # from the current position into dest
+        while (size is None) or (size > 0):
+            chunk = self.fileobj.read(1 << 20 if size is None
+                else min(size, 1 << 20))
+            if not chunk:
+                break
+            dest.write(chunk)
+            if size is not None:
+                size -= len(chunk)
+
+    def repack(self, dest_path, replacements):
+        # writes a copy of the backup to dest_path in a single sequential
+        # pass, with the contents of some files replaced. replacements maps
+        # paths (or EnoteBackupFiles) to their new contents, which can be of
+        # any size: the tar headers of replaced files get their size and
+        # checksum updated. the trailer is copied unchanged.
+        new_contents = {}
+        for key, data in replacements.items():
+            f = key if isinstance(key, EnoteBackupFile) else self.find_file(key)
+            if (f is None) or f.is_dir:
+                raise EnoteBackupError('{} not found in backup'.format(key))
+            new_contents[f.filename] = data
+
+        with open(dest_path, 'wb') as dest:
+            for f in self.files.values():
+                self.fileobj.seek(f.offset - 512)
+                header = self.fileobj.read(512)
+
+                if f.filename in new_contents:
+                    data = new_contents[f.filename]
+                    dest.write(update_header(header, len(data)))
+                    dest.write(data)
+                    dest.write(b'\x00' * (padded_size(len(data)) - len(data)))
+                else:
+                    dest.write(header)
+                    self._copy_to(dest, padded_size(f.size))
+
+            # the terminating zero block, the trailer and anything after them
+            self.fileobj.seek(self.end_offset - 512)
+            self._copy_to(dest)
+
+    def replace_files(self, replacements):
+        # like repack, but replaces the backup itself. the backup is then
+        # reopened, so EnoteBackupFiles obtained before are no longer valid.
+        tmp_path = self.filename + '.tmp'
+        self.repack(tmp_path, replacements)
+
+        self.fileobj.close()
+        os.replace(tmp_path, self.filename)
+        self.fileobj = open(self.filename, self.mode)
+        self.files = OrderedDict()
+        self._parse_files()
+
     def replace_file(self, f, data):
-        assert len(data) == f.size
+        if len(data) != f.size:
+            self.replace_files({f: data})
+            return
+
         self.fileobj.seek(f.offset)
         self.fileobj.write(data)
+
+
+def open_backup_stream(path):
+    # '-' stands for standard input. compressed backups are decompressed on
+    # the fly, so they never need to be written out to disk.
+    if path == '-':
+        return sys.stdin.buffer
+    elif path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    elif path.endswith('.xz') or path.endswith('.lzma'):
+        import lzma
+        return lzma.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        import bz2
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+class EnoteBackupStream:
+    # reads a backup in a single forward pass from any readable stream,
+    # which doesn't have to be seekable. iterating over it yields
+    # (EnoteBackupFile, data) pairs in archive order.
+    #
+    # while iterating, only the current file can be extracted. files for
+    # which keep(filename) returns True are also retained in memory, so
+    # they can be extracted (or found with find_file) later.
+    def __init__(self, fileobj, keep=None):
+        self.fileobj = fileobj
+        self.keep = keep or (lambda filename: False)
+        self.files = OrderedDict()
+        self._kept = {}
+        self._current = None
+        self._started = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.fileobj.close()
+
+    def __iter__(self):
+        for f in self.list_files():
+            yield f, self._current[1]
+
+    def _read(self, size):
+        # streams such as pipes may return less data than requested
+        chunks = []
+        while size > 0:
+            chunk = self.fileobj.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def list_files(self):
+        if self._started:
+            raise EnoteBackupError('backup stream can only be read once')
+        self._started = True
+
+        offset = 0
+        while True:
+            header = self._read(512)
+            if len(header) != 512:
+                raise EnoteBackupError('unexpected end of backup')
+            offset += 512
+
+            if header == b'\x00' * 512:
+                break
+
+            f = parse_header(header, offset)
+            data = self._read(padded_size(f.size))
+            if len(data) != padded_size(f.size):
+                raise EnoteBackupError('unexpected end of backup')
+            data = data[:f.size]
+            offset += padded_size(f.size)
+
+            self.files[f.filename] = f
+            if self.keep(f.filename):
+                self._kept[f.filename] = data
+            self._current = (f, data)
+            yield f
+
+        self._current = None
+
+        # consume the trailer and anything after it, so that whoever is
+        # writing into a pipe doesn't fail
+        while self.fileobj.read(1 << 16):
+            pass
+
+    def find_file(self, path):
+        if isinstance(path, str):
+            path = path.encode('utf-8')
+
+        return self.files.get(path)
+
+    def extract_file(self, f):
+        if (self._current is not None) and (self._current[0] == f):
+            return self._current[1]
+        if f.filename in self._kept:
+            return self._kept[f.filename]
+        raise EnoteBackupError('{} is no longer available in the stream'
+            .format(f.filename.decode('utf-8', 'replace')))
+
+    def extract_image(self, f):
+        return EnoteImage(self.extract_file(f))
@@ -3,9 +3,7 @@ import struct
 from collections import namedtuple
 from enum import Enum
 
-from PIL import Image
-
-from chicraccoon.lzrw3 import lzrw3_decompress
+from chicraccoon.lzrw3 import lzrw3_compress, lzrw3_decompress
 
 class EnoteImageMode(Enum):
     thumbnail = 0
@@ -41,30 +39,65 @@ class EnoteImageMode(Enum):
         assert False
 
 
+# maps a byte (two 4-bit pixels) to the two corresponding 8-bit pixels
+GRAYSCALE_PAIRS = [bytes([0x11 * (x >> 4), 0x11 * (x & 0xF)])
+                   for x in range(256)]
+
 class EnoteImageLayer:
     def __init__(self, pixel_data):
         self.mode = EnoteImageMode.from_pixel_data_size(len(pixel_data))
         self.pixel_data = pixel_data
 
+    @classmethod
+    def from_packed_data(cls, data):
+        # inverse of packed_data(): the endianness hack swaps pairs of bytes,
+        # so applying it again undoes it
+        layer = cls(data)
+        layer.pixel_data = layer.packed_data()
+        return layer
+
+    def packed_data(self):
+        # pixel data with two 4-bit pixels per byte, in normal order (see
+        # docs/image_format.md)
+        if not self.mode.needs_endianness_hack():
+            return bytes(self.pixel_data)
+
+        # note that this would skip the last byte if pixel_data could ever
+        # have odd length (but it cannot)
+        corrected_data = bytearray(len(self.pixel_data))
+        corrected_data[0::2] = self.pixel_data[1::2]
+        corrected_data[1::2] = self.pixel_data[0::2]
+        return bytes(corrected_data)
+
+    def grayscale_data(self):
+        # pixel data with one 8-bit pixel per byte, in normal order
+        return b''.join(map(GRAYSCALE_PAIRS.__getitem__, self.packed_data()))
+
     def to_pil(self):
-        corrected_data = []
-
-        if self.mode.needs_endianness_hack():
-            # note that this would skip the last byte if pixel_data could ever
-            # have odd length (but it cannot)
-            for i in range(len(self.pixel_data) // 2):
-                a, b = self.pixel_data[2*i], self.pixel_data[2*i + 1]
-                corrected_data.append(0x11 * (b >> 4))
-                corrected_data.append(0x11 * (b & 0xF))
-                corrected_data.append(0x11 * (a >> 4))
-                corrected_data.append(0x11 * (a & 0xF))
-        else:
-            for a in self.pixel_data:
-                corrected_data.append(0x11 * (a >> 4))
-                corrected_data.append(0x11 * (a & 0xF))
+        # Pillow takes a while to import, and isn't needed for most things
+        # that don't produce images
+        from PIL import Image
 
         return Image.frombuffer('L', self.mode.dimensions(),
-            bytes(corrected_data), 'raw', 'L', 0, 1)
+            self.grayscale_data(), 'raw', 'L', 0, 1)
+
+
+def padded_layer_size(layer_size):
+    size_padded = ((layer_size + 4) >> 9) << 9
+    if (layer_size + 4) & ((1 << 9) - 1) != 0:
+        size_padded += 1 << 9
+    return size_padded
+
+
+def parse_image_header(header):
+    # returns (number of layers, compression flag, layer sizes). only as many
+    # layer sizes as fit in the header are returned, so a corrupted number of
+    # layers can be detected by comparing it to len(layer sizes).
+    num_layers, flag = struct.unpack('<HH', header[:4])
+    count = min(num_layers, (len(header) - 4) // 4)
+    layer_sizes = list(struct.unpack('<{}L'.format(count),
+        header[4:4 + 4*count]))
+    return num_layers, flag, layer_sizes
 
 
 class EnoteImage:
@@ -74,14 +107,9 @@ class EnoteImage:
         self._parse_layers()
 
     def _parse_layers(self):
-        num_layers, flag = struct.unpack('<HH', self.data[:4])
+        _, flag, layer_sizes = parse_image_header(self.data[:512])
         needs_decompress = flag == 1
 
-        layer_sizes = []
-        for i in range(num_layers):
-            size, = struct.unpack('<L', self.data[4+4*i:4+4*(i + 1)])
-            layer_sizes.append(size)
-
         skip = 512
 
         for i, layer_size in enumerate(layer_sizes):
@@ -91,10 +119,24 @@ class EnoteImage:
 
             self.layers.append(EnoteImageLayer(pixel_data))
 
-            size_padded = ((layer_size + 4) >> 9) << 9
-            if (layer_size + 4) & ((1 << 9) - 1) != 0:
-                size_padded += 1 << 9
-            skip += size_padded
+            skip += padded_layer_size(layer_size)
+
+    @staticmethod
+    def encode(layers, compress=True):
+        # builds the contents of a .RAW file out of EnoteImageLayers
+        blocks = []
+        for layer in layers:
+            if compress:
+                blocks.append(lzrw3_compress(layer.pixel_data))
+            else:
+                blocks.append(bytes(layer.pixel_data))
+
+        header = struct.pack('<HH', len(blocks), 1 if compress else 0)
+        header += b''.join(struct.pack('<L', len(x)) for x in blocks)
+        result = [header.ljust(512, b'\x00')]
+        for block in blocks:
+            result.append(block.ljust(padded_layer_size(len(block)), b'\x00'))
+        return b''.join(result)
 
     def list_layers(self):
         return iter(self.layers)
@@ -0,0 +1,174 @@
+import mmap
+import struct
+
+from collections import namedtuple, OrderedDict
+
+from chicraccoon.enoteimage import EnoteImageMode
+
+# A layer archive stores decoded layers of many images in a single file that
+# can be mmap'ed, so that they can be read back without decoding anything.
+#
+# | length (bytes) | field |
+# | -------------- | ----- |
+# | 64     | header: magic, version, alignment, entry count, index offset/size |
+# | ...    | pixel blocks, each starting at a multiple of the alignment        |
+# | ...    | index: one entry per layer                                        |
+#
+# The index is written last, so that archives can be written incrementally;
+# its location is filled into the header when the archive is closed. Each
+# index entry is followed by the (UTF-8) path of the image it belongs to.
+#
+# Pixel blocks are in normal (row-major) order, with either two 4-bit pixels
+# per byte (like the layer data in backups, see docs/image_format.md) or one
+# 8-bit grayscale pixel per byte (like EnoteImageLayer.to_pil()).
+
+MAGIC = b'CRLAYERS'
+VERSION = 1
+ALIGNMENT = 4096
+
+HEADER = struct.Struct('<8sHHIIQQ')
+HEADER_SIZE = 64
+# offset, size, width, height, mode, layer number, bits per pixel,
+# path length
+ENTRY = struct.Struct('<QIHHBBBxH')
+
+LayerArchiveEntry = namedtuple('LayerArchiveEntry',
+    ['path', 'mode', 'layer', 'bits', 'offset', 'size'])
+
+class LayerArchiveError(Exception):
+    pass
+
+class LayerArchiveWriter:
+    def __init__(self, filename, bits=4):
+        if bits not in (4, 8):
+            raise ValueError('bits must be 4 or 8')
+
+        self.bits = bits
+        self.fileobj = open(filename, 'wb')
+        self.entries = []
+        self.fileobj.write(b'\x00' * HEADER_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _align(self):
+        position = self.fileobj.tell()
+        if position % ALIGNMENT != 0:
+            self.fileobj.write(b'\x00' * (ALIGNMENT - position % ALIGNMENT))
+
+    def add_layer(self, path, number, layer):
+        if self.bits == 4:
+            data = layer.packed_data()
+        else:
+            data = layer.grayscale_data()
+
+        self._align()
+        self.entries.append(LayerArchiveEntry(path=path, mode=layer.mode,
+            layer=number, bits=self.bits, offset=self.fileobj.tell(),
+            size=len(data)))
+        self.fileobj.write(data)
+
+    def add_image(self, path, image):
+        for i, layer in enumerate(image.list_layers()):
+            self.add_layer(path, i, layer)
+
+    def close(self):
+        if self.fileobj.closed:
+            return
+
+        index_offset = self.fileobj.tell()
+        for entry in self.entries:
+            path = entry.path.encode('utf-8')
+            width, height = entry.mode.dimensions()
+            self.fileobj.write(ENTRY.pack(entry.offset, entry.size,
+                width, height, entry.mode.value, entry.layer, entry.bits,
+                len(path)))
+            self.fileobj.write(path)
+        index_size = self.fileobj.tell() - index_offset
+
+        self.fileobj.seek(0)
+        self.fileobj.write(HEADER.pack(MAGIC, VERSION, 0, ALIGNMENT,
+            len(self.entries), index_offset, index_size))
+        self.fileobj.close()
+
+
+class LayerArchive:
+    # layers are returned as memoryviews into the mapped file (or as numpy
+    # arrays on top of them), so no data is copied. they must all be
+    # released before the archive can be closed.
+    def __init__(self, filename):
+        self.fileobj = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.fileobj.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped
+            self.fileobj.close()
+            raise LayerArchiveError('not a layer archive')
+
+        self.layers = OrderedDict()
+        self._parse_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.fileobj.close()
+
+    def _parse_index(self):
+        if len(self.map) < HEADER_SIZE:
+            raise LayerArchiveError('not a layer archive')
+
+        magic, version, _, _, count, index_offset, index_size = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise LayerArchiveError('not a layer archive')
+        if version != VERSION:
+            raise LayerArchiveError('unsupported version {}'.format(version))
+        if index_offset == 0:
+            raise LayerArchiveError('archive was not closed properly')
+
+        position = index_offset
+        for _ in range(count):
+            offset, size, _, _, mode, layer, bits, path_length = \
+                ENTRY.unpack_from(self.map, position)
+            position += ENTRY.size
+            path = self.map[position:position + path_length].decode('utf-8')
+            position += path_length
+
+            self.layers[(path, layer)] = LayerArchiveEntry(path=path,
+                mode=EnoteImageMode(mode), layer=layer, bits=bits,
+                offset=offset, size=size)
+
+    def list_layers(self):
+        return iter(self.layers.values())
+
+    def find_layer(self, path, layer):
+        return self.layers.get((path, layer))
+
+    def layer_data(self, entry):
+        return memoryview(self.map)[entry.offset:entry.offset + entry.size]
+
+    def layer_array(self, entry):
+        # numpy is optional, and only needed for this
+        import numpy
+
+        width, height = entry.mode.dimensions()
+        if entry.bits == 4:
+            width //= 2
+        return numpy.frombuffer(self.map, dtype=numpy.uint8,
+            count=entry.size, offset=entry.offset).reshape(height, width)
+
+    def to_pil(self, entry):
+        from PIL import Image
+
+        return Image.frombuffer('L', entry.mode.dimensions(),
+            self.layer_data(entry), 'raw', 'L;4' if entry.bits == 4 else 'L',
+            0, 1)
@@ -6,6 +6,93 @@ import io
 # C, can be found at the Internet Archive copy of his website,
 # https://web.archive.org/web/20170331101417/http://www.ross.net/compression/lzrw3.html
 
+# hash table entries that haven't been set yet point to this string
+START_STRING = b'123456789012345678'
+# longest string that can be encoded as a copy item
+MAX_COPY = 18
+
+def lzrw3_compress(data):
+    data = bytes(data)
+    n = len(data)
+
+    hash_table = [None for _ in range(4096)]
+    result = bytearray(b'\x00\x00\x00\x00') # FLAG_COMPRESS
+
+    # hash table entries for the last two literals. they are only filled in
+    # when a third item follows, to stay in sync with what the decompressor
+    # can compute (it needs the three bytes starting at a position to hash
+    # it).
+    literal_1 = None
+    literal_2 = None
+
+    control_pos = None
+    control = 0
+    control_bit = 1 << 16
+
+    p = 0
+    while p < n:
+        if control_bit == 1 << 16:
+            if control_pos is not None:
+                result[control_pos] = control & 0xFF
+                result[control_pos + 1] = control >> 8
+            control_pos = len(result)
+            result.extend(b'\x00\x00')
+            control = 0
+            control_bit = 1
+
+        length = 0
+        if p <= n - MAX_COPY:
+            index = (((40543*((data[p]<<8)^(data[p + 1]<<4)^data[p + 2]))>>4)
+                     & 0xFFF)
+            target = hash_table[index]
+            if target is None:
+                while (length < MAX_COPY) and \
+                    (START_STRING[length] == data[p + length]):
+                    length += 1
+            else:
+                while (length < MAX_COPY) and \
+                    (data[target + length] == data[p + length]):
+                    length += 1
+
+        if length >= 3:
+            # copy item
+            if literal_2 is not None:
+                hash_table[literal_2] = p - 2
+            if literal_1 is not None:
+                hash_table[literal_1] = p - 1
+            hash_table[index] = p
+            literal_1 = literal_2 = None
+
+            control |= control_bit
+            result.append(((index >> 4) & 0xF0) | (length - 3))
+            result.append(index & 0xFF)
+            p += length
+        else:
+            # literal item
+            if p <= n - MAX_COPY:
+                if literal_2 is not None:
+                    hash_table[literal_2] = p - 2
+                literal_2 = literal_1
+                literal_1 = index
+
+            result.append(data[p])
+            p += 1
+
+        control_bit <<= 1
+
+    if control_pos is not None:
+        # like the reference implementation, mark unused items as copies
+        control |= (1 << 16) - control_bit
+        result[control_pos] = control & 0xFF
+        result[control_pos + 1] = control >> 8
+
+    if len(result) > n + 4:
+        # compression made things worse, so the data is just copied
+        return b'\x01\x00\x00\x00' + data # FLAG_COPY
+
+    return bytes(result)
+
+
 def lzrw3_decompress(instream):
     if isinstance(instream, bytes):
         instream = io.BytesIO(instream)
@@ -25,10 +112,6 @@ def lzrw3_decompress(instream):
 
     _lzrw3_hash = lambda a, b, c: (((40543*((a<<8)^(b<<4)^c))>>4) & 0xFFF)
     lzrw3_hash = lambda p: _lzrw3_hash(result[p], result[p + 1], result[p + 2])
-    def hash_table_get(x):
-        if hash_table[x] is None:
-            return b'123456789012345678'
-        return result[hash_table[x]:]
 
 
     flag, *_ = [read_byte() for _ in range(4)]
@@ -55,8 +138,14 @@ def lzrw3_decompress(instream):
             p_hte = ((lenmt & 0xF0)<<4) | read_byte()
             lenmt &= 0xF
 
-            for i in range(lenmt + 3):
-                result.append(hash_table_get(p_hte)[i])
+            source = hash_table[p_hte]
+            if source is None:
+                result.extend(START_STRING[:lenmt + 3])
+            else:
+                # the copied string can overlap with its own output, so this
+                # has to be done byte by byte
+                for i in range(lenmt + 3):
+                    result.append(result[source + i])
 
             if literals > 0:
                 r = p_ziv - literals
@@ -85,6 +174,7 @@ def test_lzrw3():
     def test(comp, decomp):
         result = lzrw3_decompress(comp)
         assert result == decomp
+        assert lzrw3_compress(decomp) == comp
 
     test(b'\x00\x00\x00\x00\xf0\xff\x68\x61\x68\x61\x0f\xe8',
          b'hahahahahahahahahahaha')
@@ -147,6 +237,15 @@ def test_lzrw3():
           b'wait for him. The servant took hold of me by the cloak behind, and '
           b'said: Polemarchus desires you to wait.'))
 
+    def test_roundtrip(data):
+        assert lzrw3_decompress(lzrw3_compress(data)) == data
+
+    test_roundtrip(b'')
+    test_roundtrip(b'a')
+    test_roundtrip(b'123456789012345678' * 3)
+    test_roundtrip(bytes(range(256)) * 20)
+    test_roundtrip(b'\xff' * 1000 + b'\x0f\xf0' * 500 + b'\xff' * 1000)
+
 
 if __name__ == '__main__':
     test_lzrw3()
@@ -0,0 +1,144 @@
+import os
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+from chicraccoon.enoteimage import EnoteImage, EnoteImageMode
+from chicraccoon.workers import bounded_map
+
+# colors used for the layers of a page, bottom to top. they match the ones in
+# web_static/style.css: the form is black, the marker is purple and the pen is
+# black.
+FORM_COLOR = (0, 0, 0)
+PAGE_COLORS = [(0x80, 0x00, 0x80), (0, 0, 0)]
+
+class PdfWriter:
+    # writes a PDF with one full-page image per page. pages are written out
+    # as soon as they're added, and only their object offsets are kept in
+    # memory, so the memory used doesn't depend on the number of pages.
+    CATALOG_ID = 1
+    PAGES_ID = 2
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3
+        self.position = 0
+
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.position += len(data)
+
+    def _write_object(self, id_, body, stream=None):
+        self.offsets[id_] = self.position
+        self._write('{} 0 obj\n'.format(id_).encode('ascii'))
+        self._write(body.encode('ascii'))
+        if stream is not None:
+            self._write(b'\nstream\n')
+            self._write(stream)
+            self._write(b'\nendstream')
+        self._write(b'\nendobj\n')
+
+    def _allocate_ids(self, count):
+        ids = list(range(self.next_id, self.next_id + count))
+        self.next_id += count
+        return ids
+
+    def add_page(self, width, height, pixels):
+        # pixels are 8-bit RGB, compressed with zlib
+        image_id, contents_id, page_id = self._allocate_ids(3)
+
+        self._write_object(image_id,
+            ('<< /Type /XObject /Subtype /Image /Width {} /Height {} '
+             '/ColorSpace /DeviceRGB /BitsPerComponent 8 '
+             '/Filter /FlateDecode /Length {} >>').format(
+                width, height, len(pixels)),
+            pixels)
+
+        contents = 'q {} 0 0 {} 0 0 cm /Im0 Do Q'.format(width, height)
+        self._write_object(contents_id,
+            '<< /Length {} >>'.format(len(contents)),
+            contents.encode('ascii'))
+
+        self._write_object(page_id,
+            ('<< /Type /Page /Parent {} 0 R /MediaBox [0 0 {} {}] '
+             '/Resources << /XObject << /Im0 {} 0 R >> >> '
+             '/Contents {} 0 R >>').format(
+                self.PAGES_ID, width, height, image_id, contents_id))
+        self.page_ids.append(page_id)
+
+    def close(self):
+        self._write_object(self.PAGES_ID,
+            '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+                ' '.join('{} 0 R'.format(x) for x in self.page_ids),
+                len(self.page_ids)))
+        self._write_object(self.CATALOG_ID,
+            '<< /Type /Catalog /Pages {} 0 R >>'.format(self.PAGES_ID))
+
+        xref_offset = self.position
+        self._write('xref\n0 {}\n'.format(self.next_id).encode('ascii'))
+        self._write(b'0000000000 65535 f \n')
+        for id_ in range(1, self.next_id):
+            self._write('{:010} 00000 n \n'.format(
+                self.offsets[id_]).encode('ascii'))
+        self._write(('trailer\n<< /Size {} /Root {} 0 R >>\n'
+                     'startxref\n{}\n%%EOF\n').format(
+            self.next_id, self.CATALOG_ID, xref_offset).encode('ascii'))
+
+
+def render_page(images):
+    # runs in a worker process. images is a list of (raw image data, colors)
+    # pairs, bottom to top, where colors has one entry per layer to draw.
+    # returns the composited page as zlib-compressed RGB pixels.
+    from PIL import Image, ImageOps
+
+    size = EnoteImageMode.full_size.dimensions()
+    page = Image.new('RGB', size, (255, 255, 255))
+    for data, colors in images:
+        for layer, color in zip(EnoteImage(data).list_layers(), colors):
+            mask = ImageOps.invert(layer.to_pil())
+            page.paste(color, (0, 0) + size, mask)
+
+    return zlib.compress(page.tobytes())
+
+
+def export_pdf(backup, pages, dest_path, workers=None):
+    # pages is a list of (form image, page image) pairs, as returned by
+    # LocalNotebook.notebook_page_images and schedule_page_images. pages
+    # are decoded in parallel, but only a few of them at a time, so memory
+    # usage stays constant.
+    from chicraccoon.sync import LocalNotebook
+
+    files = {}
+    for f in backup.list_files():
+        if (not f.is_dir) and f.filename.lower().endswith(b'.raw'):
+            files[LocalNotebook.image_key(f.filename)] = f
+
+    def tasks():
+        for form, page in pages:
+            images = []
+            if form in files:
+                images.append((backup.extract_file(files[form]),
+                               [FORM_COLOR]))
+            if page in files:
+                images.append((backup.extract_file(files[page]),
+                               PAGE_COLORS))
+            yield images
+
+    width, height = EnoteImageMode.full_size.dimensions()
+    workers = workers or os.cpu_count() or 1
+    with open(dest_path, 'wb') as f, PdfWriter(f) as pdf, \
+        ProcessPoolExecutor(workers) as executor:
+        for pixels in bounded_map(executor, render_page, tasks(),
+            2 * workers):
+            pdf.add_page(width, height, pixels)
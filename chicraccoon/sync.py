@@ -1,21 +1,35 @@
-import calendar
 import datetime
 import json
 import os
 import os.path
 import re
-import shutil
-import sqlite3
 import struct
 import sys
+import time
 
-from jinja2 import Environment, PackageLoader, select_autoescape
-from PIL import Image
-from pkg_resources import ResourceManager, get_provider
+from chicraccoon.enotebackup import EnoteBackup, EnoteBackupStream, \
+    open_backup_stream
+from chicraccoon.enoteimage import EnoteImageMode
 
-from chicraccoon.enotebackup import EnoteBackup
+# number of page thumbnails packed into a single sprite atlas
+SPRITE_PAGES = 64
+
+# formats in which images can be stored (the value is used as the extension):
+# PNG masks that are displayed with CSS, or packed 4-bit pixel data (same as
+# EnoteImageLayer.packed_data(), optionally gzipped) that is drawn onto a
+# canvas by web_static/layers.js
+IMAGE_FORMATS = {
+    'png': 'png',
+    'packed': '4bpp',
+    'packed_gz': '4bpp.gz'
+}
+
+# Jinja2, Pillow, sqlite3 and importlib.resources are only imported in the
+# functions that use them, so that startup stays fast
 
 def grayscale_to_mask(image):
+    from PIL import Image
+
     pixels = image.tobytes()
     new_pixels = []
     for pixel in pixels:
@@ -26,16 +40,64 @@ def grayscale_to_mask(image):
     return Image.frombuffer('RGBA', image.size, bytes(new_pixels),
         'raw', 'RGBA', 0, 1)
 
+class SyncProgress:
+    # default listener for LocalNotebook events: shows running counts on a
+    # single line, redrawn at most once every `interval` seconds so that
+    # large backups don't spend their time writing to the terminal. if the
+    # output isn't a terminal, only a summary is written at the end.
+    LABELS = [
+        ('image_converted', 'converted'),
+        ('image_skipped', 'unchanged'),
+        ('image_deleted', 'deleted'),
+        ('page_rendered', 'pages rendered')
+    ]
+
+    def __init__(self, output=None, interval=0.2):
+        self.output = output or sys.stderr
+        self.interval = interval
+        self.interactive = self.output.isatty()
+        self.counts = {event: 0 for event, _ in self.LABELS}
+        self.last_draw = 0
+
+    def _line(self):
+        return ', '.join('{} {}'.format(self.counts[event], label)
+                         for event, label in self.LABELS)
+
+    def __call__(self, event, **details):
+        if event in self.counts:
+            self.counts[event] += 1
+
+        if event == 'update_finished':
+            if self.interactive:
+                self.output.write('\r\x1b[K')
+            self.output.write(self._line() + '\n')
+            self.output.flush()
+            return
+
+        now = time.monotonic()
+        if self.interactive and (now - self.last_draw >= self.interval):
+            self.output.write('\r\x1b[K' + self._line())
+            self.output.flush()
+            self.last_draw = now
+
 class LocalNotebook:
+    # events are reported to listeners added with subscribe(), which are
+    # called as listener(event, **details). the events are:
+    #   - image_converted, image_skipped, image_deleted (filename)
+    #   - page_rendered (path of the HTML file)
+    #   - update_finished (no details)
     def __init__(self, path):
         self.path = path
+        self.listeners = []
         self.d = {
             'forms': {},
             'pages': {},
             'notebooks': {},
             'images': {},
             'schedules': {},
-            'sch_pages': {}
+            'sch_pages': {},
+            'sprites': {},
+            'image_format': 'png'
         }
 
         if not os.path.exists(path):
@@ -48,6 +110,16 @@ class LocalNotebook:
                 int_maybe = lambda x: int(x) if x.isnumeric() else x
                 pairs_hook = lambda pairs: {int_maybe(k):v for k,v in pairs}
                 self.d = json.load(f, object_pairs_hook=pairs_hook)
+            # data.json files written by older versions lack some keys
+            self.d.setdefault('sprites', {})
+            self.d.setdefault('image_format', 'png')
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def _emit(self, event, **details):
+        for listener in self.listeners:
+            listener(event, **details)
 
     def save(self):
         with open(self._path('data.json'), 'w') as f:
@@ -62,6 +134,13 @@ class LocalNotebook:
     def __exit__(self, exc_type, exc_value, traceback):
         self.save()
 
+    @staticmethod
+    def is_metadata_file(filename):
+        # files that update() reads other than images. when syncing from a
+        # stream, these have to be retained until the end of the pass.
+        return (filename == b'enotes.db3') or \
+            filename.endswith(b'/PAGE_ORDER.bin')
+
     def load_page_order(self, id_, backup):
         filename = 'PAGE/N{id:06X}/PAGE_ORDER.bin'.format(id=id_)
         data = backup.extract_file(backup.find_file(filename))
@@ -132,9 +211,72 @@ class LocalNotebook:
                     self.d[kind][uform['form_id']]['notebook'] = -1
                 uforms = cursor.fetchmany()
 
+    @staticmethod
+    def image_key(filename):
+        # images are identified by their path in the backup, lowercased and
+        # with directories that are unnecessarily subdivided flattened
+        filename = filename.decode('utf-8').lower()
+        return re.sub(r'/[\da-f]{2}/', '/', filename)
+
+    def form_image(self, id_, thumb=False):
+        notebook = self.d['forms'][id_]['notebook']
+        if notebook == -1:
+            # uform
+            return '{thumb}uform/f{id:07x}.raw'.format(
+                thumb='thumbnail/' if thumb else '', id=id_)
+        elif notebook == 0:
+            # built-in form
+            return '{thumb}form/f{id:07x}.raw'.format(
+                thumb='thumbnail/' if thumb else '', id=id_)
+        else:
+            # imported form
+            return '{thumb}impt/n{nb:06x}/f{id:07x}.raw'.format(
+                thumb='thumbnail/' if thumb else '', id=id_, nb=notebook)
+
+    def page_image(self, id_, notebook, thumb=False):
+        return '{thumb}page/n{nb:06x}/{tp}{id:07x}.raw'.format(
+            thumb='thumbnail/' if thumb else '',
+            tp='t' if thumb else 'p',
+            id=id_, nb=notebook)
+
+    def sch_form_image(self, id_, schedule):
+        return 'sch_form/s{sch:06x}/f{id:07x}.raw'.format(
+            sch=schedule,
+            id=id_)
+
+    def sch_page_image(self, id_, schedule, thumb=False):
+        return '{thumb}sch_page/s{sch:06x}/{tp}{id:07x}.raw'.format(
+            thumb='thumbnail/' if thumb else '',
+            tp='t' if thumb else 'p',
+            id=id_, sch=schedule)
+
+    def notebook_page_images(self, id_):
+        # (form image, page image) for every page of a notebook, in order
+        return [(self.form_image(self.d['pages'][page_id]['form']),
+                 self.page_image(page_id, id_))
+                for page_id in self.d['notebooks'][id_]['pages']]
+
+    def schedule_page_images(self, id_, start_date=None, end_date=None):
+        # (form image, page image) for every page of a schedule that
+        # overlaps the given range of datetime.dates, in order
+        parse_date = lambda x: datetime.datetime.utcfromtimestamp(x).date()
+        result = []
+        for page_id in self.d['schedules'][id_]['pages']:
+            page = self.d['sch_pages'][page_id]
+            if (start_date is not None) and \
+                (parse_date(page['end_date']) < start_date):
+                continue
+            if (end_date is not None) and \
+                (parse_date(page['start_date']) > end_date):
+                continue
+            result.append((self.sch_form_image(page_id, id_),
+                           self.sch_page_image(page_id, id_)))
+        return result
+
     def _image_path(self, basename, layer):
         basename = basename[:-4] # removing '.raw'
-        return self._path('images', '{}_{}.png'.format(basename, layer))
+        return self._path('images', '{}_{}.{}'.format(basename, layer,
+            IMAGE_FORMATS[self.d['image_format']]))
 
     def _mkdir(self, *path):
         try:
@@ -142,12 +284,38 @@ class LocalNotebook:
         except FileExistsError:
             pass
 
+    def set_image_format(self, image_format):
+        # switching formats means that all images have to be converted again
+        if image_format == self.d['image_format']:
+            return
+
+        for filename, image in self.d['images'].items():
+            for i in range(image['layers']):
+                if os.path.exists(self._image_path(filename, i)):
+                    os.remove(self._image_path(filename, i))
+            image['mtime'] = 0
+
+        self.d['image_format'] = image_format
+
     def convert_image(self, basename, image):
+        image_format = self.d['image_format']
         for i, layer in enumerate(image.list_layers()):
-            image = grayscale_to_mask(layer.to_pil())
-            image.save(self._image_path(basename, i))
+            if image_format == 'png':
+                image = grayscale_to_mask(layer.to_pil())
+                image.save(self._image_path(basename, i))
+                continue
 
-    def update_images(self, backup):
+            data = layer.packed_data()
+            if image_format == 'packed_gz':
+                import gzip
+                data = gzip.compress(data, mtime=0)
+            with open(self._image_path(basename, i), 'wb') as f:
+                f.write(data)
+
+    def update_images(self, backup, layer_archive=None):
+        # if layer_archive (a LayerArchiveWriter) is given, the layers of all
+        # images in the backup are also written into it, whether they were
+        # updated or not
         self._mkdir('images')
 
         seen_images = set()
@@ -160,8 +328,7 @@ class LocalNotebook:
             if not filename.endswith('.raw'):
                 continue
 
-            # flatten directories that are unnecessarily subdivided
-            filename = re.sub(r'/[\da-f]{2}/', '/', filename)
+            filename = self.image_key(f.filename)
 
             seen_images.add(filename)
             if filename not in self.d['images']:
@@ -170,70 +337,89 @@ class LocalNotebook:
                     'layers': 0
                 }
 
+            image = None
             if f.mtime > self.d['images'][filename]['mtime']:
-                print('file {} updated, converting'.format(filename))
+                self._emit('image_converted', filename=filename)
                 image = backup.extract_image(f)
                 self.d['images'][filename]['mtime'] = f.mtime
                 self.d['images'][filename]['layers'] = image.layer_count()
                 self.convert_image(filename, image)
             else:
-                print('file {} not updated, skipping'.format(filename))
+                self._emit('image_skipped', filename=filename)
+
+            if layer_archive is not None:
+                if image is None:
+                    image = backup.extract_image(f)
+                layer_archive.add_image(filename, image)
 
         files_to_delete = []
         for filename in self.d['images']:
             if filename not in seen_images:
-                print('file {} deleted, deleting'.format(filename))
+                self._emit('image_deleted', filename=filename)
                 for i in range(self.d['images'][filename]['layers']):
                     os.remove(self._image_path(filename, i))
                 files_to_delete.append(filename)
         for filename in files_to_delete:
             del self.d['images'][filename]
 
-    def regenerate_web(self):
+    def update_sprite(self, filename, rows):
+        # rows is a list of lists of thumbnail paths (one row per page, one
+        # column per layer). the atlas is only rebuilt if any of the
+        # thumbnails changed since it was last built.
+        from PIL import Image
+
+        width, height = EnoteImageMode.thumbnail.dimensions()
+
+        mtime = lambda x: os.path.getmtime(x) if os.path.exists(x) else None
+        stamp = []
+        for row in rows:
+            stamp.append([[path, mtime(self._path(path))] for path in row])
+
+        if (self.d['sprites'].get(filename) == stamp) and \
+            os.path.exists(self._path(filename)):
+            return
+
+        columns = max(len(row) for row in rows)
+        atlas = Image.new('RGBA', (width * columns, height * len(rows)))
+        for y, row in enumerate(rows):
+            for x, path in enumerate(row):
+                if not os.path.exists(self._path(path)):
+                    # leave missing thumbnails transparent
+                    continue
+                with Image.open(self._path(path)) as image:
+                    atlas.paste(image, (x * width, y * height))
+        atlas.save(self._path(filename))
+
+        self.d['sprites'][filename] = stamp
+
+    def regenerate_web(self, sprites=False):
+        from importlib.resources import files
+        from jinja2 import Environment, PackageLoader, select_autoescape
+
         notebook_dirname = lambda x: 'n{:03}'.format(x)
         page_filename = lambda p, n: 'n{:03}/p{:06}.html'.format(n, p)
-        notebook_covername = lambda x: 'images/note/n{:07x}_0.png'.format(x)
+        image_url = lambda key, layer: 'images/{}_{}.{}'.format(key[:-4],
+            layer, IMAGE_FORMATS[self.d['image_format']])
+        notebook_covername = lambda x: image_url('note/n{:07x}.raw'.format(x), 0)
+        sprite_filename = lambda n, i: 'sprites/n{:03}_{}.png'.format(n, i)
         schedule_dirname = lambda x: 's{:03}'.format(x)
         sch_page_filename = lambda p, n: 's{:03}/p{:06}.html'.format(n, p)
-        schedule_covername = lambda x: 'images/schedule/s{:07x}_0.png'.format(x)
+        schedule_covername = lambda x: image_url('schedule/s{:07x}.raw'.format(x), 0)
         def form_filename(id_, thumb=False):
-            notebook = self.d['forms'][id_]['notebook']
-            if notebook == -1:
-                # uform
-                return 'images/{thumb}uform/f{id:07x}_0.png'.format(
-                    thumb='thumbnail/' if thumb else '', id=id_)
-            elif notebook == 0:
-                # built-in form
-                return 'images/{thumb}form/f{id:07x}_0.png'.format(
-                    thumb='thumbnail/' if thumb else '', id=id_)
-            else:
-                # imported form
-                return 'images/{thumb}impt/n{nb:06x}/f{id:07x}_0.png'.format(
-                    thumb='thumbnail/' if thumb else '', id=id_, nb=notebook)
+            return image_url(self.form_image(id_, thumb), 0)
         def page_imagename(id_, notebook, layer, thumb=False):
-            return 'images/{thumb}page/n{nb:06x}/{tp}{id:07x}_{layer}.png'.format(
-                thumb='thumbnail/' if thumb else '',
-                tp='t' if thumb else 'p',
-                id=id_, nb=notebook, layer=layer)
+            return image_url(self.page_image(id_, notebook, thumb), layer)
         def sch_form_filename(id_, schedule):
-            return 'images/sch_form/s{sch:06x}/f{id:07x}_0.png'.format(
-                sch=schedule,
-                id=id_)
+            return image_url(self.sch_form_image(id_, schedule), 0)
         def sch_page_imagename(id_, schedule, layer, thumb=False):
-            return 'images/{thumb}sch_page/s{sch:06x}/{tp}{id:07x}_{layer}.png'.format(
-                thumb='thumbnail/' if thumb else '',
-                tp='t' if thumb else 'p',
-                id=id_, sch=schedule, layer=layer)
-
+            return image_url(self.sch_page_image(id_, schedule, thumb), layer)
 
         # copy over static files
         self._mkdir('static')
 
-        provider = get_provider('chicraccoon')
-        static_dir = provider.get_resource_filename(
-            ResourceManager(), 'web_static')
-        for entry in os.scandir(static_dir):
-            shutil.copy(entry.path, self._path('static'))
+        for entry in files('chicraccoon').joinpath('web_static').iterdir():
+            with open(self._path('static', entry.name), 'wb') as f:
+                f.write(entry.read_bytes())
 
         # generate HTML
         env = Environment(
@@ -242,26 +428,38 @@ class LocalNotebook:
             trim_blocks=True,
             lstrip_blocks=True
         )
+        # in canvas mode, the templates draw layers with web_static/layers.js
+        # instead of using them as CSS masks
+        canvas = self.d['image_format'] != 'png'
+        env.globals['canvas'] = canvas
+        # sprites are made from PNG thumbnails, so they're only used with them
+        sprites = sprites and not canvas
 
         # generate index page
         index_template = env.get_template('index.html')
         notebooks = []
         for id_ in self.d['notebooks']:
             cover = notebook_covername(id_)
+            cover_canvas = canvas
             if not os.path.exists(self._path(cover)):
                 cover = 'static/notebook_default.png'
+                cover_canvas = False
             notebooks.append({
                 'link': '{}/index.html'.format(notebook_dirname(id_)),
-                'cover': cover
+                'cover': cover,
+                'canvas': cover_canvas
             })
         schedules = []
         for id_ in self.d['schedules']:
             cover = schedule_covername(id_)
+            cover_canvas = canvas
             if not os.path.exists(self._path(cover)):
                 cover = 'static/schedule_default.png'
+                cover_canvas = False
             schedules.append({
                 'link': '{}/index.html'.format(schedule_dirname(id_)),
-                'cover': cover
+                'cover': cover,
+                'canvas': cover_canvas
             })
 
         with open(self._path('index.html'), 'w') as f:
@@ -270,6 +468,9 @@ class LocalNotebook:
                 schedules=schedules))
 
         # generate note and notebook pages
+        if sprites:
+            self._mkdir('sprites')
+        seen_sprites = set()
         notebook_template = env.get_template('notebook.html')
         page_template = env.get_template('notebook_page.html')
         for id_, notebook in self.d['notebooks'].items():
@@ -304,13 +505,41 @@ class LocalNotebook:
                         pages_total=len(page_ids),
                         prev_link=prev_link,
                         next_link=next_link))
+                self._emit('page_rendered', path=page_filename(page_id, id_))
 
-                pages.append({'layers': thumb_layers,
+                pages.append({
+                    'layers': [{'url': l} for l in thumb_layers],
                     'link': page_filename(page_id, id_)})
 
+            if sprites:
+                # replace the individual thumbnails with sprite atlases,
+                # so that the index page only needs a few requests
+                width, height = EnoteImageMode.thumbnail.dimensions()
+                for i in range(0, len(pages), SPRITE_PAGES):
+                    chunk = pages[i:i + SPRITE_PAGES]
+                    filename = sprite_filename(id_, i // SPRITE_PAGES)
+                    self.update_sprite(filename,
+                        [[l['url'] for l in page['layers']] for page in chunk])
+                    seen_sprites.add(filename)
+
+                    for y, page in enumerate(chunk):
+                        for x, layer in enumerate(page['layers']):
+                            layer['url'] = filename
+                            layer['position'] = '{}px {}px'.format(
+                                -x * width, -y * height)
+
             with open(self._path(notebook_dirname(id_), 'index.html'), 'w') as f:
                 f.write(notebook_template.render(pages=pages, base_dir='../'))
 
+        sprites_to_delete = []
+        for filename in self.d['sprites']:
+            if filename not in seen_sprites:
+                if os.path.exists(self._path(filename)):
+                    os.remove(self._path(filename))
+                sprites_to_delete.append(filename)
+        for filename in sprites_to_delete:
+            del self.d['sprites'][filename]
+
         # generate schedule pages
         one_day = datetime.timedelta(days=1)
         parse_date = lambda x: datetime.datetime.utcfromtimestamp(x).date()
@@ -390,9 +619,20 @@ class LocalNotebook:
                         next_link=next_link,
                         start_date=start_date,
                         end_date=end_date))
+                self._emit('page_rendered',
+                    path=sch_page_filename(page_id, id_))
+
+    def update(self, backup, sprites=False, layer_archive=None,
+            image_format='png'):
+        import sqlite3
+
+        self.set_image_format(image_format)
 
+        # images are handled first, so that a backup that can only be read
+        # in a single pass (EnoteBackupStream) has been read in full by the
+        # time the metadata is loaded
+        self.update_images(backup, layer_archive=layer_archive)
 
-    def update(self, backup):
         with open(self._path('tmp.sqlite3'), 'wb') as f:
             f.write(backup.extract_file(backup.find_file('enotes.db3')))
 
@@ -408,21 +648,66 @@ class LocalNotebook:
         db.close()
         os.remove(self._path('tmp.sqlite3'))
 
-        self.update_images(backup)
-        self.regenerate_web()
+        self.regenerate_web(sprites=sprites)
+        self._emit('update_finished')
 
 def main():
-    if len(sys.argv) != 3:
+    options = [x for x in sys.argv[1:] if x.startswith('--')]
+    args = [x for x in sys.argv[1:] if not x.startswith('--')]
+
+    layer_archive_path = None
+    for option in options:
+        if option.startswith('--layer-archive='):
+            layer_archive_path = option.split('=', 1)[1]
+
+    if (len(args) != 2) or \
+        any(x not in ('--sprites', '--stream', '--canvas', '--gzip',
+                      '--quiet') and
+            not x.startswith('--layer-archive=') for x in options):
         print('USAGE:')
-        print('{} <notebook-directory> <path/to/enote.bkup>'.format(sys.argv[0]))
+        print('{} [options] <notebook-directory> <path/to/enote.bkup>'.format(sys.argv[0]))
+        print('options:')
+        print('  --sprites               pack notebook page thumbnails into sprite atlases')
+        print('  --stream                read the backup in a single forward pass (implied')
+        print('                          for - (standard input) and .gz/.xz/.bz2 backups)')
+        print('  --layer-archive=<path>  also write all decoded layers into a layer archive')
+        print('  --canvas                store layers as packed pixel data, and draw them')
+        print('                          with JavaScript instead of converting them to PNG')
+        print('  --gzip                  with --canvas, gzip the packed pixel data')
+        print('  --quiet                 do not report progress')
         return
 
-    notebook_dir = sys.argv[1]
-    backup_path = sys.argv[2]
+    notebook_dir = args[0]
+    backup_path = args[1]
+
+    stream = ('--stream' in options) or (backup_path == '-') or \
+        backup_path.endswith(('.gz', '.xz', '.lzma', '.bz2'))
+
+    image_format = 'png'
+    if '--canvas' in options:
+        image_format = 'packed_gz' if '--gzip' in options else 'packed'
+
+    layer_archive = None
+    if layer_archive_path is not None:
+        from chicraccoon.layerarchive import LayerArchiveWriter
+        layer_archive = LayerArchiveWriter(layer_archive_path)
 
     with LocalNotebook(notebook_dir) as notebook:
-        with EnoteBackup(backup_path) as backup:
-            notebook.update(backup)
+        if '--quiet' not in options:
+            notebook.subscribe(SyncProgress())
+
+        if stream:
+            backup = EnoteBackupStream(open_backup_stream(backup_path),
+                keep=LocalNotebook.is_metadata_file)
+        else:
+            backup = EnoteBackup(backup_path)
+
+        with backup:
+            notebook.update(backup, sprites='--sprites' in options,
+                layer_archive=layer_archive, image_format=image_format)
+
+    if layer_archive is not None:
+        layer_archive.close()
 
 if __name__ == '__main__':
     main()
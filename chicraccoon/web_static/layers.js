@@ -0,0 +1,81 @@
+// Draws images stored as packed 4-bit pixel data (two pixels per byte,
+// 0 is black and 15 is white) onto canvases. Every <canvas class="layers">
+// lists the URLs of its layers, bottom to top, in data-layers; layers are
+// drawn with the same colors that style.css uses for the CSS masks.
+
+(function () {
+    var COLORS = [[0, 0, 0], [0x80, 0x00, 0x80], [0, 0, 0]];
+
+    function fetchLayer(url) {
+        return fetch(url).then(function (response) {
+            if (!response.ok) {
+                throw new Error('failed to load ' + url);
+            }
+            if (url.endsWith('.gz')) {
+                var stream = response.body.pipeThrough(
+                    new DecompressionStream('gzip'));
+                return new Response(stream).arrayBuffer();
+            }
+            return response.arrayBuffer();
+        });
+    }
+
+    function drawLayers(canvas) {
+        var urls = canvas.dataset.layers.split(' ').filter(function (x) {
+            return x.length > 0;
+        });
+
+        Promise.all(urls.map(fetchLayer)).then(function (layers) {
+            var context = canvas.getContext('2d');
+            var image = context.createImageData(canvas.width, canvas.height);
+            var pixels = image.data;
+            var count = canvas.width * canvas.height;
+
+            pixels.fill(255);
+            layers.forEach(function (buffer, i) {
+                var packed = new Uint8Array(buffer);
+                var color = COLORS[i % COLORS.length];
+
+                for (var p = 0; p < count; p++) {
+                    var byte = packed[p >> 1];
+                    var value = (p & 1) ? (byte & 0xF) : (byte >> 4);
+                    if (value === 15) {
+                        continue;
+                    }
+
+                    // the darker the pixel, the more opaque the layer is
+                    var alpha = (15 - value) / 15;
+                    var o = 4 * p;
+                    pixels[o] += (color[0] - pixels[o]) * alpha;
+                    pixels[o + 1] += (color[1] - pixels[o + 1]) * alpha;
+                    pixels[o + 2] += (color[2] - pixels[o + 2]) * alpha;
+                }
+            });
+
+            context.putImageData(image, 0, 0);
+        });
+    }
+
+    window.addEventListener('load', function () {
+        var canvases = document.querySelectorAll('canvas.layers');
+
+        if (!('IntersectionObserver' in window)) {
+            canvases.forEach(drawLayers);
+            return;
+        }
+
+        // only load layers of canvases that are (about to be) visible, so
+        // that long notebooks don't fetch all their thumbnails at once
+        var observer = new IntersectionObserver(function (entries) {
+            entries.forEach(function (entry) {
+                if (entry.isIntersecting) {
+                    observer.unobserve(entry.target);
+                    drawLayers(entry.target);
+                }
+            });
+        }, {rootMargin: '500px'});
+        canvases.forEach(function (canvas) {
+            observer.observe(canvas);
+        });
+    });
+})();
@@ -0,0 +1,14 @@
+from collections import deque
+
+def bounded_map(executor, fn, iterable, window):
+    # like executor.map, but never has more than `window` tasks in flight, so
+    # that large inputs (such as image data read from a backup) don't all end
+    # up in memory at once. results are yielded in order.
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
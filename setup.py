@@ -31,6 +31,8 @@ setup(
 
     packages=['chicraccoon'],
 
+    python_requires='>=3.9',
+
     install_requires=['Pillow', 'Jinja2'],
 
     package_data={